@@ -1,5 +1,16 @@
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional - without it the decorated functions run as plain Python
+    def njit(*args, **kwargs):
+        def decorate(func):
+            return func
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return decorate
+
 
 def print_output(info_string):
     """ Decorator that prints the output of a function, together with an information string. """
@@ -61,6 +61,7 @@ The functions in this file can are used to create the following functions:
     copy the parameters from optimized P function to the target P function.
 
 """
+import numpy as np
 import tensorflow as tf
 import baselines.common.tf_util as U
 
@@ -82,6 +83,10 @@ def pick_actions(cvar_values):
 
 debug_expressions = []
 
+# tile size along the quantile axis of the (B, n, n) loss tensors; one block of
+# this width is materialized at a time so it stays cache-resident for large n
+QUANT_TILE = 32
+
 
 def pick_action(cvar_values, alpha, nb_atoms):
     """
@@ -145,6 +150,18 @@ def build_act(make_obs_ph, cvar_func, var_func, num_actions, nb_atoms, scope="cv
     act: (tf.Variable, bool, float, float) -> tf.Variable
         function to select and action given observation.
 `       See the top of the file for details.
+    """
+    act, _, _, _ = _build_act(make_obs_ph, cvar_func, var_func, num_actions, nb_atoms, scope=scope, reuse=reuse)
+    return act
+
+
+def _build_act(make_obs_ph, cvar_func, var_func, num_actions, nb_atoms, scope="cvar_dqn", reuse=None):
+    """ Creates the act function together with the tensors it is built from,
+    so that build_train can reuse the forward pass. See build_act.
+
+    Returns
+    -------
+    (act, observations_ph, cvar_values, var_values)
     """
     with tf.variable_scope(scope, reuse=reuse):
         observations_ph = U.ensure_tf_input(make_obs_ph("observation"))
@@ -165,18 +182,22 @@ def build_act(make_obs_ph, cvar_func, var_func, num_actions, nb_atoms, scope="cv
         deterministic_actions = pick_action(cvar_values, alpha_ph.get(), nb_atoms)
 
         batch_size = tf.shape(observations_ph.get())[0]
-        random_actions = tf.random_uniform(tf.stack([batch_size]), minval=0, maxval=num_actions, dtype=tf.int32)
-        chose_random = tf.random_uniform(tf.stack([batch_size]), minval=0, maxval=1, dtype=tf.float32) < eps
-        stochastic_actions = tf.where(chose_random, random_actions, deterministic_actions)
-
-        output_actions = tf.cond(stochastic_ph, lambda: stochastic_actions, lambda: deterministic_actions)
-        update_eps_expr = eps.assign(tf.cond(update_eps_ph >= 0, lambda: update_eps_ph, lambda: eps))
+        # one RNG launch covers both the exploration coin flip and the random action
+        rand = tf.random_uniform(tf.stack([batch_size, 2]), minval=0, maxval=1, dtype=tf.float32)
+        random_actions = tf.cast(rand[:, 0] * num_actions, tf.int32)
+        chose_random = rand[:, 1] < eps
+
+        # both branches are already computed, so fold the stochastic switch into
+        # the same select instead of opening a tf.cond frame
+        output_actions = tf.where(tf.logical_and(chose_random, stochastic_ph), random_actions, deterministic_actions)
+        # scalar select instead of a tf.cond frame; assigning eps to itself is a no-op
+        update_eps_expr = eps.assign(tf.where(update_eps_ph >= 0, update_eps_ph, eps))
         act = U.function(inputs=[observations_ph, alpha_ph, stochastic_ph, update_eps_ph],
                          outputs=output_actions,
                          givens={update_eps_ph: -1.0, stochastic_ph: True},
                          updates=[update_eps_expr])
 
-        return act
+        return act, observations_ph, cvar_values, var_values
 
 
 def extract_distribution(y_cvar, nb_atoms):
@@ -190,7 +211,7 @@ def extract_distribution(y_cvar, nb_atoms):
 
 
 def build_train(make_obs_ph, var_func, cvar_func, num_actions, nb_atoms, optimizer, grad_norm_clipping=None, gamma=1.0,
-                scope="cvar_dqn", reuse=None):
+                scope="cvar_dqn", reuse=None, shared_obs=False, quantize_target=False):
     """Creates the train function:
 
     Parameters
@@ -225,6 +246,14 @@ def build_train(make_obs_ph, var_func, cvar_func, num_actions, nb_atoms, optimiz
         optional scope for variable_scope.
     reuse: bool or None
         whether or not the variables should be reused. To be able to reuse the scope must be given.
+    shared_obs: bool
+        if True the train function consumes the same observation placeholder as act
+        and reuses its forward pass instead of running the network again on obs_t.
+        Only valid when every train batch is the same batch that was fed to act.
+    quantize_target: bool
+        if True the target network output is fake-quantized to int8 with running
+        min/max calibration. The target is only used for the (non-differentiable)
+        Bellman target, so the learner itself stays fp32.
 
     Returns
     -------
@@ -240,31 +269,42 @@ def build_train(make_obs_ph, var_func, cvar_func, num_actions, nb_atoms, optimiz
     debug: {str: function}
         a bunch of functions to print debug data like q_values.
     """
-    act_f = build_act(make_obs_ph, cvar_func, var_func, num_actions, nb_atoms, scope=scope, reuse=reuse)
+    act_f, act_obs_ph, act_cvar_values, act_var_values = _build_act(make_obs_ph, cvar_func, var_func,
+                                                                    num_actions, nb_atoms, scope=scope, reuse=reuse)
 
     with tf.variable_scope(scope, reuse=reuse):
         # set up placeholders
-        obs_t_input = U.ensure_tf_input(make_obs_ph("obs_t"))
+        if shared_obs:
+            # train consumes the observations already fed to act
+            obs_t_input = act_obs_ph
+        else:
+            obs_t_input = U.ensure_tf_input(make_obs_ph("obs_t"))
         act_t_ph = tf.placeholder(tf.int32, [None], name="action")
         rew_t_ph = tf.placeholder(tf.float32, [None], name="reward")
         obs_tp1_input = U.ensure_tf_input(make_obs_ph("obs_tp1"))
         done_mask_ph = tf.placeholder(tf.float32, [None], name="done")
         importance_weights_ph = tf.placeholder(tf.float32, [None], name="weight")
-        # atoms
-        y = tf.range(1, nb_atoms + 1, dtype=tf.float32, name='y') * 1. / nb_atoms
+        # atoms, inlined as a graph constant so it can be folded into the loss
+        y = tf.constant(np.arange(1, nb_atoms + 1) / nb_atoms, dtype=tf.float32, name='y')
 
         # ------------------------------- Core networks ---------------------------------
         # var network
-        var_t = var_func(obs_t_input.get(), num_actions, nb_atoms, scope="out_func",
-                         reuse_main=True, reuse_last=True) # reuse from act
+        if shared_obs:
+            var_t = act_var_values  # reuse forward pass from act
+        else:
+            var_t = var_func(obs_t_input.get(), num_actions, nb_atoms, scope="out_func",
+                             reuse_main=True, reuse_last=True) # reuse from act
 
         # vars for actions which we know were selected in the given state.
         var_t_selected = gather_along_second_axis(var_t, act_t_ph)
         var_t_selected.set_shape([None, nb_atoms])
 
         # cvar network
-        cvar_t = cvar_func(obs_t_input.get(), num_actions, nb_atoms, scope="out_func",
-                           reuse_main=True, reuse_last=True)  # reuse from act
+        if shared_obs:
+            cvar_t = act_cvar_values  # reuse forward pass from act
+        else:
+            cvar_t = cvar_func(obs_t_input.get(), num_actions, nb_atoms, scope="out_func",
+                               reuse_main=True, reuse_last=True)  # reuse from act
 
         # cvars for actions which we know were selected in the given state.
         cvar_t_selected = gather_along_second_axis(cvar_t, act_t_ph)
@@ -273,6 +313,19 @@ def build_train(make_obs_ph, var_func, cvar_func, num_actions, nb_atoms, optimiz
         # target cvar network
         cvar_tp1 = cvar_func(obs_tp1_input.get(), num_actions, nb_atoms, scope="target_cvar_func")
 
+        if quantize_target:
+            # static int8 quantization of the target activations: calibrate a
+            # running min/max range and fake-quantize the output on every step
+            quant_min = tf.get_variable("target_quant_min", (), trainable=False,
+                                        initializer=tf.constant_initializer(0.))
+            quant_max = tf.get_variable("target_quant_max", (), trainable=False,
+                                        initializer=tf.constant_initializer(0.))
+            update_range = tf.group(
+                quant_min.assign(tf.minimum(quant_min, tf.reduce_min(cvar_tp1))),
+                quant_max.assign(tf.maximum(quant_max, tf.reduce_max(cvar_tp1))))
+            with tf.control_dependencies([update_range]):
+                cvar_tp1 = tf.fake_quant_with_min_max_vars(cvar_tp1, quant_min, quant_max, num_bits=8)
+
         # extract variables
         joint_variables = U.scope_vars(U.absolute_scope_name("out_func/net"))
         var_variables = U.scope_vars(U.absolute_scope_name("out_func/var"))
@@ -290,40 +343,69 @@ def build_train(make_obs_ph, var_func, cvar_func, num_actions, nb_atoms, optimiz
         dist_tp1_star_ = extract_distribution(ycvar_tp1_star, nb_atoms)
 
         # apply done mask
-        dist_tp1_star = tf.einsum('ij,i->ij', dist_tp1_star_, 1. - done_mask_ph)
+        dist_tp1_star = dist_tp1_star_ * (1. - done_mask_ph)[:, None]
 
         # Td = r + gamma * dist
-        dist_target = tf.identity(rew_t_ph[:, None] + gamma * dist_tp1_star, name='dist_target')
         # dist is always non-differentiable
-        dist_target = tf.stop_gradient(dist_target)
-
-        # -------------------------------------------------------------------------------
-
-        # ---------------------------------- VaR loss -----------------------------------
+        dist_target = tf.stop_gradient(rew_t_ph[:, None] + gamma * dist_tp1_star, name='dist_target')
 
-        td_error = dist_target[:, :, None] - var_t_selected[:, None, :]
-        # td_error[0]=
-        #  [[Td1-v1 Td1-v2 ... Td1-vn]
-        #   [Td2-v1 Td2-v2 ... Td2-vn]
-        #   [...                     ]
-        #   [Tdn-v1 Tdn-v2 ... Tdn-vn]]
-
-        negative_indicator = tf.cast(td_error < 0, tf.float32)
-
-        var_weights = tf.stop_gradient(y - negative_indicator)  # XXX: stop gradient?
-        quantile_loss = var_weights * td_error
-
-        var_error = tf.reduce_mean(quantile_loss)
         # -------------------------------------------------------------------------------
 
-        # ---------------------------------- CVaR loss ----------------------------------
-        # Minimizing the MSE of:
-        # V_i + 1/y_i(Td_j - V_i)^- - C_i
-
-        min_target_diff = negative_indicator / y * tf.stop_gradient(td_error)
-        cvar_loss = tf.stop_gradient(var_t_selected)[:, None, :] + min_target_diff - cvar_t_selected[:, None, :]
-
-        cvar_error = tf.reduce_mean(tf.square(cvar_loss))
+        # ------------------------------ VaR + CVaR loss --------------------------------
+        def quantile_losses(dist_target, var_t_selected, cvar_t_selected):
+            """ Elementwise loss chain over the (B, n, n) pairwise differences.
+
+            Built inside an XLA jit scope so the ops fuse into one cluster and
+            the intermediates stay in registers instead of making five round
+            trips through memory. The quantile axis is processed in
+            QUANT_TILE-wide blocks, so only a (B, n, QUANT_TILE) slab is live
+            at a time; per-tile sums are accumulated and normalized once at
+            the end.
+            """
+            # the (B, n, n) pairwise tensors are memory-bound, so keep them in bfloat16
+            # and only cast back to fp32 for the reductions; network weights stay fp32
+            target_16 = tf.cast(dist_target, tf.bfloat16)[:, :, None]
+            var_t_selected_16 = tf.cast(var_t_selected, tf.bfloat16)
+            y_16 = tf.cast(y, tf.bfloat16)
+
+            var_sum = tf.constant(0., tf.float32)
+            cvar_sum = tf.constant(0., tf.float32)
+            for k in range(0, nb_atoms, QUANT_TILE):
+                y_tile = y_16[k:k + QUANT_TILE]
+                td_error = target_16 - var_t_selected_16[:, None, k:k + QUANT_TILE]
+                # td_error[0]=
+                #  [[Td1-v1 Td1-v2 ... Td1-vn]
+                #   [Td2-v1 Td2-v2 ... Td2-vn]
+                #   [...                     ]
+                #   [Tdn-v1 Tdn-v2 ... Tdn-vn]]
+
+                negative_indicator = tf.cast(td_error < 0, tf.bfloat16)
+
+                var_weights = tf.stop_gradient(y_tile - negative_indicator)  # XXX: stop gradient?
+                quantile_loss = var_weights * td_error
+
+                var_sum += tf.reduce_sum(tf.cast(quantile_loss, tf.float32))
+
+                # Minimizing the MSE of:
+                # V_i + 1/y_i(Td_j - V_i)^- - C_i
+                min_target_diff = tf.cast(negative_indicator / y_tile * tf.stop_gradient(td_error), tf.float32)
+                cvar_loss = tf.stop_gradient(var_t_selected)[:, None, k:k + QUANT_TILE] + min_target_diff \
+                    - cvar_t_selected[:, None, k:k + QUANT_TILE]
+
+                cvar_sum += tf.reduce_sum(tf.square(cvar_loss))
+
+            batch_size = tf.cast(tf.shape(dist_target)[0], tf.float32)
+            # canonical quantile-regression scale: sum over the quantile axis,
+            # mean over batch and target atoms; the CVaR MSE stays a full mean
+            var_error = var_sum / (batch_size * nb_atoms)
+            cvar_error = cvar_sum / (batch_size * nb_atoms * nb_atoms)
+
+            return var_error, cvar_error
+
+        # auto-clustering jit scope rather than xla.compile: the latter's cluster
+        # outputs have no gradient, which would break optimizer.minimize below
+        with tf.contrib.compiler.jit.experimental_jit_scope():
+            var_error, cvar_error = quantile_losses(dist_target, var_t_selected, cvar_t_selected)
 
         # -------------------------------------------------------------------------------
 
@@ -342,7 +424,10 @@ def build_train(make_obs_ph, var_func, cvar_func, num_actions, nb_atoms, optimiz
         update_target_expr = []
         for cvar_variable, target_cvar_variable in zip(sorted(joint_variables+cvar_variables, key=lambda v: v.name),
                                                        sorted(target_cvar_func_variables, key=lambda v: v.name)):
-            update_target_expr.append(target_cvar_variable.assign(cvar_variable))
+            # colocate the copy with its destination; nothing else writes the
+            # target variables, so the assigns can run lock-free in parallel
+            with tf.colocate_with(target_cvar_variable):
+                update_target_expr.append(target_cvar_variable.assign(cvar_variable, use_locking=False))
         update_target_expr = tf.group(*update_target_expr)
 
         # Create callable functions
@@ -378,6 +463,4 @@ def build_train(make_obs_ph, var_func, cvar_func, num_actions, nb_atoms, optimiz
 
 
 def gather_along_second_axis(data, indices):
-    batch_offset = tf.range(0, tf.shape(data)[0])
-    flat_indices = tf.stack([batch_offset, indices], axis=1)
-    return tf.gather_nd(data, flat_indices)
+    return tf.gather(data, indices, batch_dims=1)
@@ -3,7 +3,7 @@ from cvar.gridworld.core.constants import *
 from cvar.gridworld.core import cvar_computation
 import numpy as np
 from cvar.gridworld.plots.grid import InteractivePlotMachine
-from cvar.common.util import timed, spaced_atoms
+from cvar.common.util import timed, spaced_atoms, njit
 
 
 class ActionValueFunction:
@@ -12,100 +12,108 @@ class ActionValueFunction:
         self.world = world
         self.atoms = atoms
         self.atom_p = self.atoms[1:] - self.atoms[:-1]
-
-        self.Q = np.empty((world.height, world.width, len(world.ACTIONS)), dtype=object)
-        for ix in np.ndindex(self.Q.shape):
-            self.Q[ix] = MarkovQState(self.atoms)
+        # hoisted constants used by every update
+        self.atoms1 = self.atoms[1:]
+        self.inv_atoms1 = 1. / self.atoms1
+
+        # VaR and yCVaR estimates interleaved in one dense block, so both vectors
+        # of a (y, x, a) cell share cache lines; V and yC are views into Q
+        self.Q = np.zeros((world.height, world.width, len(world.ACTIONS), 2, NB_ATOMS))
+        self.V = self.Q[..., 0, :]
+        self.yC = self.Q[..., 1, :]
+
+        # (y, x) -> extracted joint distribution, invalidated when the state is updated
+        self._dist_cache = {}
+
+    def __getstate__(self):
+        # V and yC are views into Q; pickling them as-is would break the aliasing
+        state = self.__dict__.copy()
+        del state['V'], state['yC']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.V = self.Q[..., 0, :]
+        self.yC = self.Q[..., 1, :]
 
     def update_safe(self, x, a, x_, r, beta, id=None):
         """ Naive TD update that ensures yCVaR convexity. """
         V_x = self.joint_action_dist(x_)
 
+        V = self.V[x.y, x.x, a]
+        yC = self.yC[x.y, x.x, a]
         for v in V_x:
-            for i, atom in enumerate(self.atoms[1:]):
-                V = self.Q[x.y, x.x, a].V[i]
-                yC = self.Q[x.y, x.x, a].yc[i]
+            for i, atom in enumerate(self.atoms1):
+                V_i = V[i]
+                yC_i = yC[i]
 
                 # learning rates
                 lr_v = beta * self.atom_p[i]  # p mirrors magnitude (for log-spaced)
                 lr_yc = beta * self.atom_p[i]
                 # lr_yc = beta * atom_p[i] / atom  # /atom for using the same beta when estimating cvar (not yc)
 
-                if self.Q[x.y, x.x, a].V[i] >= r + gamma*v:
+                if V[i] >= r + gamma*v:
                     update = lr_v*(1-1/atom)
                 else:
                     update = lr_v
 
                 # UPDATE VaR
                 if i == 0:
-                    self.Q[x.y, x.x, a].V[i] = min(self.Q[x.y, x.x, a].V[i] + update, self.Q[x.y, x.x, a].V[i+1])
+                    V[i] = min(V[i] + update, V[i+1])
                 elif i == (len(self.atoms)-2):
-                    self.Q[x.y, x.x, a].V[i] = max(self.Q[x.y, x.x, a].V[i] + update, self.Q[x.y, x.x, a].V[i-1])
+                    V[i] = max(V[i] + update, V[i-1])
                 else:
-                    self.Q[x.y, x.x, a].V[i] = min(max(self.Q[x.y, x.x, a].V[i] + update, self.Q[x.y, x.x, a].V[i-1]),
-                                                   self.Q[x.y, x.x, a].V[i+1])
+                    V[i] = min(max(V[i] + update, V[i-1]), V[i+1])
 
                 # UPDATE CVaR
-                yCn = (1 - lr_yc) * yC + lr_yc * (atom*V + min(0, r+gamma*v - V))
+                yCn = (1 - lr_yc) * yC_i + lr_yc * (atom*V_i + min(0, r+gamma*v - V_i))
                 if i == 0:
-                    self.Q[x.y, x.x, a].yc[i] = yCn
+                    yC[i] = yCn
                 elif i == 1:
-                    ddy = self.Q[x.y, x.x, a].yc[0] / self.atom_p[0]  # TODO: check
-                    self.Q[x.y, x.x, a].yc[i] = max(yCn, self.Q[x.y, x.x, a].yc[i - 1] + ddy * self.atom_p[i])
+                    ddy = yC[0] / self.atom_p[0]  # TODO: check
+                    yC[i] = max(yCn, yC[i - 1] + ddy * self.atom_p[i])
                 else:
-                    ddy = (self.Q[x.y, x.x, a].yc[i-1] - self.Q[x.y, x.x, a].yc[i-2]) / self.atom_p[i-1] # TODO: check
-                    self.Q[x.y, x.x, a].yc[i] = max(yCn, self.Q[x.y, x.x, a].yc[i-1] + ddy*self.atom_p[i])
+                    ddy = (yC[i-1] - yC[i-2]) / self.atom_p[i-1] # TODO: check
+                    yC[i] = max(yCn, yC[i-1] + ddy*self.atom_p[i])
+
+        self._dist_cache.pop((x.y, x.x), None)
 
     def update_naive(self, x, a, x_, r, beta, id=None):
-        """ Naive (read slow) CVaR TD update. """
+        """ Naive CVaR TD update, vectorized over the atom axis. """
         V_x = self.joint_action_dist(x_)
-        print('standard')
-        # TODO: vectorize/cythonize
+
+        atoms = self.atoms1
+        V = self.V[x.y, x.x, a]
+        yC = self.yC[x.y, x.x, a]
         for iv, v in enumerate(V_x):
-            for i, atom in enumerate(self.atoms[1:]):
-                V = self.Q[x.y, x.x, a].V[i]
-                yC = self.Q[x.y, x.x, a].yc[i]
+            V_old = V.copy()
 
-                # learning rates
-                lr_v = beta * self.atom_p[iv]  # p mirrors magnitude (for log-spaced)
-                # lr_yc = beta * atom_p[iv] / atom  # /atom for using the same beta when estimating cvar (not yc)
-                lr_yc = beta * self.atom_p[iv]
+            # learning rates
+            lr_v = beta * self.atom_p[iv]  # p mirrors magnitude (for log-spaced)
+            # lr_yc = beta * atom_p[iv] / atom  # /atom for using the same beta when estimating cvar (not yc)
+            lr_yc = beta * self.atom_p[iv]
 
-                if self.Q[x.y, x.x, a].V[i] >= r + gamma * v:
-                    update = lr_v * (1 - 1 / atom)
-                else:
-                    update = lr_v
+            target = r + gamma * v
 
-                # UPDATE VaR
-                self.Q[x.y, x.x, a].V[i] += update
+            # UPDATE VaR
+            V += lr_v * np.where(V_old >= target, 1 - self.inv_atoms1, 1.)
 
-                # UPDATE CVaR
-                yCn = (1 - lr_yc) * yC + lr_yc * (atom*V + min(0, r+gamma*v - V))
-                self.Q[x.y, x.x, a].yc[i] = yCn
+            # UPDATE CVaR
+            yC[:] = (1 - lr_yc) * yC + lr_yc * (atoms*V_old + np.minimum(0, target - V_old))
+
+        self._dist_cache.pop((x.y, x.x), None)
 
     def update(self, x, a, x_, r, beta, id=None):
         """ Vectorized CVaR TD update. """
         d = self.joint_action_dist(x_)
 
-        V = np.array(self.Q[x.y, x.x, a].V)
-        C = np.array(self.Q[x.y, x.x, a].yc) / self.atoms[1:]
-
-        # row is a single atom update
-        # shape=(n, n)
-        indicator_mask = self.Q[x.y, x.x, a].V[:, None] >= r + gamma * d
-
-        V_update = 1 - indicator_mask / self.atoms[1:, None]
-
-        self.Q[x.y, x.x, a].V += beta * np.average(V_update, axis=1, weights=self.atom_p)
+        _td_update(self.V[x.y, x.x, a], self.yC[x.y, x.x, a], self.atoms1, self.inv_atoms1, self.atom_p, d, r, beta)
 
-        C_update = V[:, None] + np.clip(r + gamma * d - V[:, None], a_min=None, a_max=0) / self.atoms[1:, None]
-
-        C_new = (1 - beta) * C + beta * np.average(C_update, axis=1, weights=self.atom_p)
-        self.Q[x.y, x.x, a].yc = C_new * self.atoms[1:]
+        self._dist_cache.pop((x.y, x.x), None)
 
 
     def next_action_alpha(self, x, alpha):
-        yc = [self.Q[x.y, x.x, a].yc_alpha(alpha) for a in self.world.ACTIONS]
+        yc = [yc_alpha(self.atoms, self.yC[x.y, x.x, a], alpha) for a in self.world.ACTIONS]
         return np.argmax(yc)
 
     def next_action_s(self, x, s):
@@ -113,39 +121,41 @@ class ActionValueFunction:
         Select best action according to E[(Z-s)^-].
         If multiple 0's, use yCVaR_0.
         """
-        return max(self.world.ACTIONS, key=lambda a: (self.Q[x.y, x.x, a].cvar_pre_s(s), self.Q[x.y, x.x, a].yc[0]))
+        return max(self.world.ACTIONS,
+                   key=lambda a: (cvar_pre_s(self.atoms, self.atom_p, self.V[x.y, x.x, a], self.yC[x.y, x.x, a], s),
+                                  self.yC[x.y, x.x, a, 0]))
 
     def joint_action_dist(self, x, return_yc=False):
         """
         Returns a distribution representing the value function at state x.
         Constructed by taking a supremum of yC over actions for each atom.
         """
-        yc = [np.max([self.Q[x.y, x.x, a].yc[i] for a in self.world.ACTIONS]) for i in range(NB_ATOMS)]
-
         if return_yc:
-            return yc
-        else:
-            return cvar_computation.yc_to_var(self.atoms, yc)
+            return self.yC[x.y, x.x].max(axis=0)
+
+        dist = self._dist_cache.get((x.y, x.x))
+        if dist is None:
+            yc = self.yC[x.y, x.x].max(axis=0)
+            dist = cvar_computation.yc_to_var(self.atoms, yc)
+            self._dist_cache[(x.y, x.x)] = dist
+        return dist
 
     def joint_action_dist_var(self, x):
         """
         Returns VaR estimates of the joint distribution.
         Constructed by taking a supremum of yC over actions for each atom.
         """
-        info = [max([(self.Q[x.y, x.x, a].yc[i], self.Q[x.y, x.x, a].V[i]) for a in self.world.ACTIONS]) for i in range(NB_ATOMS)]
+        a_star = self.yC[x.y, x.x].argmax(axis=0)
 
-        return [ycv[1] for ycv in info]
+        return self.V[x.y, x.x][a_star, np.arange(NB_ATOMS)]
 
     def var_alpha(self, x, a, alpha):
         """
         Get VaR_alpha using interpolation
         """
-        i = 0
-        for i in range(len(self.atoms)):
-            if alpha < self.atoms[i]:
-                break
-        v_low = self.Q[x.y, x.x, a].V[i-2]
-        v_high = self.Q[x.y, x.x, a].V[i-1]
+        i = min(int(np.searchsorted(self.atoms, alpha, side='right')), len(self.atoms) - 1)
+        v_low = self.V[x.y, x.x, a, i-2]
+        v_high = self.V[x.y, x.x, a, i-1]
 
         p_low = self.atoms[i-1]
         p_high = self.atoms[i]
@@ -176,6 +186,37 @@ class ActionValueFunction:
 
         return p_low + (s - v_low) / (v_high - v_low) * (p_high - p_low)
 
+    def yc_alphas(self, alpha):
+        """ yCVaR_alpha estimates for the whole table, shape=(height, width, actions). """
+        shape = self.yC.shape[:-1]
+        return np.array([yc_alpha(self.atoms, self.yC[ix], alpha) for ix in np.ndindex(shape)]).reshape(shape)
+
+    def plot_state(self, y, x, a, show=True, ax=None):
+        import matplotlib.pyplot as plt
+        if ax is None:
+            _, ax = plt.subplots(1, 3)
+
+        V = self.V[y, x, a]
+        yc = self.yC[y, x, a]
+
+        # yC
+        ax[0].plot(self.atoms, np.insert(yc, 0, 0), '-')
+
+        # yC-> var
+        v = cvar_computation.yc_to_var(self.atoms, yc)
+        ax[1].step(self.atoms, list(v) + [v[-1]], '-', where='post')
+
+        # var
+        ax[2].step(self.atoms, list(V) + [V[-1]], '-', where='post')
+
+        # titles
+        ax[0].set_title('yCVaR')
+        ax[1].set_title('Extracted Distribution')
+        ax[2].set_title('VaR')
+
+        if show:
+            plt.show()
+
     def optimal_path(self, alpha):
         """ Optimal deterministic path. """
         from cvar.gridworld.core.policies import VarBasedQPolicy, XiBasedQPolicy, NaiveQPolicy, VarXiQPolicy
@@ -199,80 +240,59 @@ def is_convex(yc, atoms):
     return is_ordered(cvar_computation.yc_to_var(atoms, yc))
 
 
-class MarkovQState:
+# ===================================================================
+# free functions operating on single (y, x, a) slices of V / yC
+# ===================================================================
 
-    def __init__(self, atoms):
-        self.atoms = atoms
-        self.V = np.zeros(NB_ATOMS)  # VaR estimate
-        self.yc = np.zeros(NB_ATOMS)  # CVaR estimate
+@njit(cache=True)
+def _td_update(V, yC, atoms1, inv_atoms1, atom_p, d, r, beta):
+    """ Vectorized CVaR TD update of a single (y, x, a) cell, in place.
 
-    def plot(self, show=True, ax=None):
-        import matplotlib.pyplot as plt
-        if ax is None:
-            _, ax = plt.subplots(1, 3)
+    JIT-compiled when numba is available; the body is plain array
+    arithmetic so it also runs unchanged without it.
+    """
+    C = yC * inv_atoms1
+    target = r + gamma * d
 
-        # yC
-        ax[0].plot(self.atoms, np.insert(self.yc, 0, 0), '-')
+    # row is a single atom update
+    # shape=(n, n)
+    indicator_mask = (V.reshape(-1, 1) >= target).astype(np.float64)
 
-        # yC-> var
-        v = self.dist_from_yc()
-        ax[1].step(self.atoms, list(v) + [v[-1]], '-', where='post')
+    V_update = 1 - indicator_mask * inv_atoms1.reshape(-1, 1)
 
-        # var
-        ax[2].step(self.atoms, list(self.V) + [self.V[-1]], '-', where='post')
+    C_update = V.reshape(-1, 1) + np.minimum(target - V.reshape(-1, 1), 0) * inv_atoms1.reshape(-1, 1)
 
-        # titles
-        ax[0].set_title('yCVaR')
-        ax[1].set_title('Extracted Distribution')
-        ax[2].set_title('VaR')
+    # weighted means written as multiply-and-sum: numba lowers np.dot through
+    # BLAS and would require scipy, which is not a dependency
+    p_sum = atom_p.sum()
+    V += beta * (V_update * atom_p).sum(axis=1) / p_sum
 
-        if show:
-            plt.show()
+    C_new = (1 - beta) * C + beta * (C_update * atom_p).sum(axis=1) / p_sum
+    yC[:] = C_new * atoms1
 
-    def expected_value(self):
-        return self.yc[-1]
 
-    def yc_alpha(self, alpha):
-        """ linear interpolation: yC(alpha)"""
-        i = 0
-        for i in range(1, len(self.atoms)):
-            if alpha < self.atoms[i]:
-                break
-        alpha_portion = (alpha - self.atoms[i-1]) / (self.atoms[i] - self.atoms[i-1])
-        if i == 1:  # between 0 and first atom
-            return alpha_portion * self.yc[i-1]
-        else:
-            return self.yc[i-2] + alpha_portion * (self.yc[i-1] - self.yc[i-2])
-
-    def var_alpha(self, alpha):
-        """ VaR estimate of alpha. """
-        # TODO: check
-        last_v = self.V[0]
-        for p, v in zip(self.atoms[1:], self.V):
-            if p > alpha:
-                break
-            last_v = v
-        return last_v
+def yc_alpha(atoms, yc, alpha):
+    """ linear interpolation: yC(alpha)"""
+    i = min(int(np.searchsorted(atoms, alpha, side='right')), len(atoms) - 1)
+    alpha_portion = (alpha - atoms[i-1]) / (atoms[i] - atoms[i-1])
+    if i == 1:  # between 0 and first atom
+        return alpha_portion * yc[i-1]
+    else:
+        return yc[i-2] + alpha_portion * (yc[i-1] - yc[i-2])
 
-    def cvar_pre_s(self, s):
-        """ E[(V-s)^-] + ys.
 
-        Uses the actual VaR for th cutoff and yC->VaR for the expectation.
-        """
-        yc = 0
-
-        for ix, v_yc in enumerate(self.dist_from_yc()):
-            v = self.V[ix]
-            p = self.atoms[ix+1] - self.atoms[ix]
-            if v < s:
-                yc += p * v_yc
-            else:
-                break
+def cvar_pre_s(atoms, atom_p, V, yc, s):
+    """ E[(V-s)^-] + ys.
 
-        return yc
+    Uses the actual VaR for th cutoff and yC->VaR for the expectation.
+    """
+    # V is sorted, so the cutoff is a binary search and the expectation a dot product
+    k = int(np.searchsorted(V, s))
+    if k == 0:
+        return 0.
 
-    def dist_from_yc(self):
-        return cvar_computation.yc_to_var(self.atoms, self.yc)
+    dist = cvar_computation.yc_to_var(atoms, yc)
+    return float(np.dot(atom_p[:k], dist[:k]))
 
 
 @timed
@@ -352,4 +372,5 @@ def eps_greedy(a, eps, action_space):
 
 
 def q_to_v_exp(Q):
-    return np.max(np.array([Q.Q[ix].expected_value() for ix in np.ndindex(Q.Q.shape)]).reshape(Q.Q.shape), axis=-1)
+    # yC at the last atom is the expected value
+    return np.max(Q.yC[..., -1], axis=-1)
@@ -11,6 +11,8 @@ _from_t: extract the desired value from weighted list of distributions
 """
 import numpy as np
 
+from cvar.common.util import njit
+
 
 # ===================================================================
 # Single:
@@ -160,17 +162,35 @@ def single_yc_lp_from_t(transition_p, t_atoms, yc_values, alpha, xis=False):
 # Distribution <=> vector
 # ===================================================================
 
-def yc_to_var(atoms, y_cvar):
-    """ yCVaR -> distribution. Outputs same atoms as input. """
+@njit(cache=True)
+def _yc_to_var(atoms, y_cvar, var):
     last = 0.
-    var = np.zeros_like(y_cvar)
-
-    for i in range(len(atoms) - 1):
+    for i in range(y_cvar.shape[0]):
         p = atoms[i + 1] - atoms[i]
-        ddy = (y_cvar[i] - last) / p
-        var[i] = ddy
+        var[i] = (y_cvar[i] - last) / p
         last = y_cvar[i]
 
+
+@njit(cache=True)
+def _yc_to_var_batch(atoms, y_cvar, var):
+    for j in range(y_cvar.shape[0]):
+        _yc_to_var(atoms, y_cvar[j], var[j])
+
+
+def yc_to_var(atoms, y_cvar):
+    """ yCVaR -> distribution. Outputs same atoms as input. """
+    y_cvar = np.asarray(y_cvar, dtype=np.float64)
+    var = np.empty_like(y_cvar)
+    _yc_to_var(np.asarray(atoms, dtype=np.float64), y_cvar, var)
+    return var
+
+
+def yc_to_var_batch(atoms, y_cvar):
+    """ yc_to_var over the last axis of a (..., n) array of yCVaRs. """
+    y_cvar = np.ascontiguousarray(y_cvar, dtype=np.float64)
+    var = np.empty_like(y_cvar)
+    _yc_to_var_batch(np.asarray(atoms, dtype=np.float64),
+                     y_cvar.reshape(-1, y_cvar.shape[-1]), var.reshape(-1, var.shape[-1]))
     return var
 
 
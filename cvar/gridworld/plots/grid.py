@@ -57,7 +57,7 @@ class InteractivePlotMachine:
         self.world = world
         self.V = V
         if action_value:
-            img = np.max(np.array([V.Q[ix].yc_alpha(alpha)/alpha for ix in np.ndindex(V.Q.shape)]).reshape(V.Q.shape), axis=-1)
+            img = np.max(V.yc_alphas(alpha)/alpha, axis=-1)
             print(img.shape)
 
             self.fig, self.ax = grid_plot(world, img)
@@ -121,7 +121,7 @@ class InteractivePlotMachine:
             ax.clear()
 
         for a in self.world.ACTIONS:
-            self.V.Q[y, x, a].plot(ax=self.state_ax, show=False)
+            self.V.plot_state(y, x, a, ax=self.state_ax, show=False)
         ax.legend([self.world.ACTION_NAMES[a] for a in self.world.ACTIONS])
 
         # combination of all actions
@@ -3,7 +3,7 @@ import numpy as np
 import cvar.gridworld.plots.grid as grid
 import matplotlib
 import matplotlib.pyplot as plt
-from cvar.gridworld.algorithms.q_learning import ActionValueFunction, MarkovQState
+from cvar.gridworld.algorithms.q_learning import ActionValueFunction
 from cvar.gridworld.algorithms.value_iteration import ValueFunction, MarkovState
 from cycler import cycler
 from cvar.gridworld.core.runs import epoch
@@ -27,7 +27,7 @@ def optimal_paths_grids(file_name, save_name=None, vi=False):
         if vi:
             img = np.array([model.V[ix].cvar_alpha(alpha) for ix in np.ndindex(model.V.shape)]).reshape(model.V.shape)
         else:
-            img = np.max(np.array([model.Q[ix].yc_alpha(alpha)/alpha for ix in np.ndindex(model.Q.shape)]).reshape(model.Q.shape), axis=-1)
+            img = np.max(model.yc_alphas(alpha)/alpha, axis=-1)
         grid.grid_plot(world, img=img, figax=(fig, ax), sg_size=10)
 
         path = model.optimal_path(alpha)